@@ -1,119 +1,209 @@
 # app.py
 import streamlit as st
-import pandas as pd
-import zipfile, json, re
+import zipfile, json, re, codecs
+from collections import defaultdict
 from io import BytesIO
+from sys import intern
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 st.set_page_config(page_title="Auditoria Power BI", layout="wide")
 st.title("🔎 Auditoria de Modelos Power BI (.pbit)")
 
+# -----------------------------
+# Padrões compilados (reutilizados entre reruns)
+# -----------------------------
+DAX_REF_PATTERN = re.compile(r"'?([A-Za-z0-9_ ]+)'?\[([A-Za-z0-9_ ]+)\]")
+WHITESPACE_TABLE = str.maketrans("", "", " \t\n\r\f\v")
+
 # -----------------------------
 # Upload do arquivo .pbit
 # -----------------------------
 uploaded_file = st.file_uploader("Escolha o arquivo .pbit", type="pbit")
 
 if uploaded_file:
+    import pandas as pd
+
     st.success(f"Arquivo carregado: {uploaded_file.name}")
 
     # -----------------------------
     # Funções auxiliares
     # -----------------------------
-    DAX_REF_PATTERN = re.compile(r"'?([A-Za-z0-9_ ]+)'?\[([A-Za-z0-9_ ]+)\]")
-
     def extract_table_column_refs_from_text(text):
         used = set()
-        if not text:
-            return used
-        if isinstance(text, list):
-            text = "\n".join(text)
-        if not isinstance(text, str):
+        if not text or "[" not in text:
             return used
         for m in DAX_REF_PATTERN.finditer(text):
             if m.group(1) and m.group(2):
-                used.add((m.group(1).strip(), m.group(2).strip()))
+                used.add((intern(m.group(1).strip()), intern(m.group(2).strip())))
         return used
 
     # -----------------------------
     # Função de auditoria
     # -----------------------------
-    def audit_model(pbit_file_obj):
+    @st.cache_data(show_spinner=False)
+    def audit_model(pbit_bytes):
         results = {
-            "unused_columns": [],
-            "duplicate_measures": [],
-            "missing_descriptions": [],
-            "orphan_tables": []
+            "unused_columns": {"table": [], "column": []},
+            "duplicate_measures": {"table1": [], "measure1": [], "table2": [], "measure2": [], "expression": []},
+            "missing_descriptions": {"table": [], "name": []},
+            "orphan_tables": {"table": []}
         }
-
-        with zipfile.ZipFile(pbit_file_obj, "r") as z:
-            model_json = json.loads(z.read("DataModelSchema"))
+        unused = results["unused_columns"]
+        duplicates = results["duplicate_measures"]
+        missing = results["missing_descriptions"]
+
+        with zipfile.ZipFile(BytesIO(pbit_bytes), "r") as z:
+            raw = z.read("DataModelSchema")
+        # O DataModelSchema costuma vir em UTF-16; orjson só aceita UTF-8 em bytes
+        if raw.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+            raw = raw.decode("utf-16")
+        elif raw[:1] == b"\x00":
+            raw = raw.decode("utf-16-be")
+        elif raw[1:2] == b"\x00":
+            raw = raw.decode("utf-16-le")
+        elif raw.startswith(codecs.BOM_UTF8):
+            raw = raw[len(codecs.BOM_UTF8):]
+        model_json = json_loads(raw)
 
         tables = model_json.get("model", {}).get("tables", [])
         relationships = model_json.get("model", {}).get("relationships", [])
 
-        measure_list = []
+        all_columns = []
         used_in_measures = set()
+        expr_groups = defaultdict(list)
 
         for t in tables:
-            tname = t["name"]
+            tname = intern(t["name"])
             for c in t.get("columns", []):
-                cname = c["name"]
+                cname = intern(c["name"])
+                all_columns.append((tname, cname))
                 desc = c.get("description", "")
                 if not desc:
-                    results["missing_descriptions"].append((tname, cname))
+                    missing["table"].append(tname)
+                    missing["name"].append(cname)
             for m in t.get("measures", []):
                 mname = m["name"]
                 expr = m.get("expression", "") or ""
                 if isinstance(expr, list):
                     expr = "\n".join(expr)
                 desc = m.get("description", "")
-                measure_list.append({"table": tname, "measure": mname, "expression": expr, "desc": desc})
+                expr_groups[expr.translate(WHITESPACE_TABLE).lower()].append(
+                    {"table": tname, "measure": mname, "expression": expr}
+                )
                 used_in_measures |= extract_table_column_refs_from_text(expr)
                 if not desc:
-                    results["missing_descriptions"].append((tname, mname))
-
-        for t in tables:
-            tname = t["name"]
-            for c in t.get("columns", []):
-                cname = c["name"]
-                from_list = [(r.get("fromTable"), r.get("fromColumn")) for r in relationships]
-                to_list = [(r.get("toTable"), r.get("toColumn")) for r in relationships]
-                if (tname, cname) not in used_in_measures and \
-                   (tname, cname) not in from_list and \
-                   (tname, cname) not in to_list:
-                    results["unused_columns"].append((tname, cname))
-
-        expr_map = {}
-        for m in measure_list:
-            expr = m["expression"] or ""
-            norm_expr = expr.strip().replace(" ", "").lower()
-            if norm_expr in expr_map:
-                results["duplicate_measures"].append((expr_map[norm_expr], m))
-            else:
-                expr_map[norm_expr] = m
+                    missing["table"].append(tname)
+                    missing["name"].append(mname)
+
+        from_set = {(intern(r.get("fromTable") or ""), intern(r.get("fromColumn") or "")) for r in relationships}
+        to_set = {(intern(r.get("toTable") or ""), intern(r.get("toColumn") or "")) for r in relationships}
+
+        for tname, cname in all_columns:
+            if (tname, cname) not in used_in_measures and \
+               (tname, cname) not in from_set and \
+               (tname, cname) not in to_set:
+                unused["table"].append(tname)
+                unused["column"].append(cname)
+
+        for g in expr_groups.values():
+            for other in g[1:]:
+                duplicates["table1"].append(g[0]["table"])
+                duplicates["measure1"].append(g[0]["measure"])
+                duplicates["table2"].append(other["table"])
+                duplicates["measure2"].append(other["measure"])
+                duplicates["expression"].append(g[0]["expression"])
 
         related_tables = set([r["fromTable"] for r in relationships] + [r["toTable"] for r in relationships])
         for t in tables:
             if t["name"] not in related_tables:
-                results["orphan_tables"].append(t["name"])
-
-        results_df = {
-            "unused_columns": pd.DataFrame(results["unused_columns"], columns=["table", "column"]),
-            "duplicate_measures": pd.DataFrame([
-                {"table1": m1["table"], "measure1": m1["measure"], 
-                 "table2": m2["table"], "measure2": m2["measure"], 
-                 "expression": m1["expression"]}
-                for m1, m2 in results["duplicate_measures"]
-            ]),
-            "missing_descriptions": pd.DataFrame(results["missing_descriptions"], columns=["table", "name"]),
-            "orphan_tables": pd.DataFrame(results["orphan_tables"], columns=["table"])
+                results["orphan_tables"]["table"].append(t["name"])
+
+        results_df = {key: pd.DataFrame(columns) for key, columns in results.items()}
+
+        return results_df, [t["name"] for t in tables]
+
+    # -----------------------------
+    # Geração do Excel
+    # -----------------------------
+    def column_widths(df):
+        return {
+            col: min(max(len(str(col)), df[col].head(200).astype(str).str.len().max() if not df.empty else 0) + 2, 50)
+            for col in df.columns
         }
 
-        return results_df, tables, measure_list
+    @st.cache_data(show_spinner=False)
+    def build_excel(results, table_names):
+        col_widths = {sheet_name: column_widths(df) for sheet_name, df in results.items()}
+
+        output = BytesIO()
+        with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
+            workbook = writer.book
+
+            # Abas de auditoria
+            header_format = workbook.add_format({'bold': True, 'bg_color': '#DCE6F1', 'border': 1})
+            for sheet_name, df in results.items():
+                safe_name = sheet_name[:31]
+                df.to_excel(writer, sheet_name=safe_name, index=False)
+                worksheet = writer.sheets[safe_name]
+                for col_num, value in enumerate(df.columns):
+                    worksheet.write(0, col_num, value, header_format)
+                    worksheet.set_column(col_num, col_num, col_widths[sheet_name][value])
+
+            # Aba Ranking
+            ranking_df = pd.DataFrame({"table": table_names})
+            unused_counts = results["unused_columns"].groupby("table").size()
+            ranking_df["colunas_nao_usadas"] = ranking_df["table"].map(unused_counts).fillna(0).astype(int)
+            missing_counts = results["missing_descriptions"].groupby("table").size()
+            ranking_df["campos_sem_descricao"] = ranking_df["table"].map(missing_counts).fillna(0).astype(int)
+            if results["duplicate_measures"].empty:
+                ranking_df["medidas_duplicadas"] = 0
+            else:
+                dup_counts = results["duplicate_measures"].groupby("table1").size()
+                ranking_df["medidas_duplicadas"] = ranking_df["table"].map(dup_counts).fillna(0).astype(int)
+
+            ranking_df.to_excel(writer, sheet_name="Ranking_Problemas", index=False)
+            ranking_ws = writer.sheets["Ranking_Problemas"]
+
+            header_fmt = workbook.add_format({'bold': True, 'bg_color': '#FFD966', 'border':1})
+            ranking_widths = column_widths(ranking_df)
+            for col_num, value in enumerate(ranking_df.columns):
+                ranking_ws.write(0, col_num, value, header_fmt)
+                ranking_ws.set_column(col_num, col_num, ranking_widths[value])
+
+            # Barras de progresso na aba Ranking
+            for col_letter in ["B","C","D"]:
+                ranking_ws.conditional_format(f"{col_letter}2:{col_letter}{len(ranking_df)+1}",
+                                              {'type':'data_bar','bar_color':'#4F81BD'})
+
+            # Aba Dashboard
+            dashboard = workbook.add_worksheet("Dashboard")
+            categories = ["Colunas não usadas", "Medidas duplicadas", "Campos sem descrição", "Tabelas órfãs"]
+            values = [len(results["unused_columns"]), len(results["duplicate_measures"]),
+                      len(results["missing_descriptions"]), len(results["orphan_tables"])]
+            dashboard.write_row("A1", ["Categoria", "Quantidade"])
+            for i, cat in enumerate(categories):
+                dashboard.write_row(f"A{i+2}", [cat, values[i]])
+
+            chart = workbook.add_chart({'type':'column'})
+            chart.add_series({
+                'categories': f"=Dashboard!$A$2:$A${len(categories)+1}",
+                'values': f"=Dashboard!$B$2:$B${len(categories)+1}",
+                'data_labels': {'value': True}
+            })
+            chart.set_title({'name': 'Resumo da Auditoria'})
+            dashboard.insert_chart('D2', chart)
+
+        return output.getvalue()
 
     # -----------------------------
     # Rodar auditoria
     # -----------------------------
-    results, all_tables, all_measures = audit_model(uploaded_file)
+    pbit_bytes = uploaded_file.getvalue()
+    results, table_names = audit_model(pbit_bytes)
 
     # -----------------------------
     # Mostrar resumo
@@ -130,67 +220,11 @@ if uploaded_file:
     # Criar Excel com Dashboard, Ranking e Auditoria
     # -----------------------------
     st.header("💾 Download Excel Completo")
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-        workbook = writer.book
-
-        # Abas de auditoria
-        for sheet_name, df in results.items():
-            safe_name = sheet_name[:31]
-            df.to_excel(writer, sheet_name=safe_name, index=False)
-            worksheet = writer.sheets[safe_name]
-            header_format = workbook.add_format({'bold': True, 'bg_color': '#DCE6F1', 'border': 1})
-            for col_num, value in enumerate(df.columns):
-                worksheet.write(0, col_num, value, header_format)
-                max_len = max(df[value].astype(str).map(len).max(), len(value)) + 2 if not df.empty else len(value)+2
-                worksheet.set_column(col_num, col_num, max_len)
-
-        # Aba Ranking
-        ranking_df = pd.DataFrame({"table": [t["name"] for t in all_tables]})
-        ranking_df["colunas_nao_usadas"] = ranking_df["table"].apply(
-            lambda x: len([c for t,c in results["unused_columns"].values if t==x])
-        )
-        ranking_df["campos_sem_descricao"] = ranking_df["table"].apply(
-            lambda x: len([c for t,c in results["missing_descriptions"].values if t==x])
-        )
-        if results["duplicate_measures"].empty:
-            ranking_df["medidas_duplicadas"] = 0
-        else:
-            ranking_df["medidas_duplicadas"] = ranking_df["table"].apply(
-                lambda x: len([m for m in results["duplicate_measures"]["table1"].values if m==x])
-            )
-
-        ranking_df.to_excel(writer, sheet_name="Ranking_Problemas", index=False)
-        ranking_ws = writer.sheets["Ranking_Problemas"]
-
-        header_fmt = workbook.add_format({'bold': True, 'bg_color': '#FFD966', 'border':1})
-        for col_num, value in enumerate(ranking_df.columns):
-            ranking_ws.write(0, col_num, value, header_fmt)
-            max_len = max(ranking_df[value].astype(str).map(len).max(), len(value)) + 2
-            ranking_ws.set_column(col_num, col_num, max_len)
-
-        # Barras de progresso na aba Ranking
-        for col_letter in ["B","C","D"]:
-            ranking_ws.conditional_format(f"{col_letter}2:{col_letter}{len(ranking_df)+1}",
-                                          {'type':'data_bar','bar_color':'#4F81BD'})
-
-        # Aba Dashboard
-        dashboard = workbook.add_worksheet("Dashboard")
-        categories = ["Colunas não usadas", "Medidas duplicadas", "Campos sem descrição", "Tabelas órfãs"]
-        values = [len(results["unused_columns"]), len(results["duplicate_measures"]),
-                  len(results["missing_descriptions"]), len(results["orphan_tables"])]
-        dashboard.write_row("A1", ["Categoria", "Quantidade"])
-        for i, cat in enumerate(categories):
-            dashboard.write_row(f"A{i+2}", [cat, values[i]])
-
-        chart = workbook.add_chart({'type':'column'})
-        chart.add_series({
-            'categories': f"=Dashboard!$A$2:$A${len(categories)+1}",
-            'values': f"=Dashboard!$B$2:$B${len(categories)+1}",
-            'data_labels': {'value': True}
-        })
-        chart.set_title({'name': 'Resumo da Auditoria'})
-        dashboard.insert_chart('D2', chart)
-
-    output.seek(0)
-    st.download_button("📥 Baixar Excel da Auditoria", data=output, file_name="Auditoria_Modelo_PBI.xlsx")
+
+    def mark_excel_requested():
+        st.session_state["excel_file_id"] = uploaded_file.file_id
+
+    st.button("Gerar arquivo Excel", on_click=mark_excel_requested)
+    if st.session_state.get("excel_file_id") == uploaded_file.file_id:
+        excel_bytes = build_excel(results, table_names)
+        st.download_button("📥 Baixar Excel da Auditoria", data=excel_bytes, file_name="Auditoria_Modelo_PBI.xlsx")